@@ -522,6 +522,27 @@ _C.MODEL.RESNETS.RADIX = 1
 # Bottleneck_width in ResNeSt
 _C.MODEL.RESNETS.BOTTLENECK_WIDTH = 64
 
+# Run the backbone in channels_last (NHWC) memory format.
+# Faster cuDNN convolutions on Tensor Core GPUs (Volta and newer).
+_C.MODEL.RESNETS.CHANNELS_LAST = False
+# Compile the backbone forward with torch.compile(mode="reduce-overhead").
+# Requires PyTorch >= 2.0.
+_C.MODEL.RESNETS.COMPILE = False
+# Fold BatchNorm layers into the preceding convs of the backbone (see ResNet.fuse_bn)
+# after the weights are loaded by DefaultPredictor, and by tools/train_net.py --eval-only
+# and tools/benchmark.py. Inference only: the model can no longer be trained afterwards.
+_C.MODEL.RESNETS.FUSE_BN_EVAL = False
+# Run the backbone under fp16 autocast at inference (implies CHANNELS_LAST). Training
+# stays in fp32: there is no GradScaler. Requires PyTorch >= 1.6.
+_C.MODEL.RESNETS.FP16 = False
+# Replace the three 3x3 convs of the deep stem by a single 7x7 conv of the same output
+# width, as in the original ResNet stem. Cheaper on the full-resolution input, but the
+# weights of a deep stem do not carry over: the model has to be fine-tuned.
+_C.MODEL.RESNETS.STEM_FUSED = False
+# Capture the backbone forward into a CUDA graph at the first inference call, and replay
+# it for later inputs of the same shape. Requires PyTorch >= 1.10.
+_C.MODEL.RESNETS.CUDA_GRAPH = False
+
 
 # ---------------------------------------------------------------------------- #
 # Solver
@@ -32,7 +32,7 @@ from detectron2.evaluation import (
     print_csv_format,
     verify_results,
 )
-from detectron2.modeling import build_model
+from detectron2.modeling import ResNet, build_model
 from detectron2.solver import build_lr_scheduler, build_optimizer
 from detectron2.utils import comm
 from detectron2.utils.collect_env import collect_env_info
@@ -185,6 +185,10 @@ class DefaultPredictor:
 
         checkpointer = DetectionCheckpointer(self.model)
         checkpointer.load(cfg.MODEL.WEIGHTS)
+        if cfg.MODEL.RESNETS.FUSE_BN_EVAL:
+            for module in self.model.modules():
+                if isinstance(module, ResNet):
+                    module.fuse_bn()
 
         self.transform_gen = T.ResizeShortestEdge(
             [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
@@ -1,6 +1,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
-import numpy as np
-import fvcore.nn.weight_init as weight_init
+import math
+import operator
+from functools import reduce
+from itertools import chain
 import torch
 import torch.nn.functional as F
 from torch import nn
@@ -9,14 +11,25 @@ from detectron2.layers import (
     CNNBlockBase,
     Conv2d,
     DeformConv,
+    FrozenBatchNorm2d,
     ModulatedDeformConv,
     ShapeSpec,
     get_norm,
 )
+from detectron2.utils.env import TORCH_VERSION
 
 from .backbone import Backbone
 from .build import BACKBONE_REGISTRY
 
+try:
+    # A lazily loaded submodule: `torch._dynamo` is not an attribute until it is imported.
+    import torch._dynamo as _dynamo
+except ImportError:  # PyTorch < 2.0
+    _dynamo = None
+
+# Set by build_resnet_backbone once a backbone is compiled (MODEL.RESNETS.COMPILE)
+_compile_enabled = False
+
 # from IPython.core.debugger import set_trace
 
 __all__ = [
@@ -31,6 +44,153 @@ __all__ = [
 ]
 
 
+@torch.jit.script
+def _fused_residual_relu(out, shortcut):
+    """
+    Residual addition followed by ReLU. Scripted so that the JIT fuser can emit the
+    addition and the ReLU as a single pointwise kernel on GPU.
+    """
+    return torch.relu(out + shortcut)
+
+
+def _residual_relu(out, shortcut):
+    if _compile_enabled and _dynamo.is_compiling():
+        # TorchDynamo cannot trace into scripted functions; inductor fuses this itself.
+        return torch.relu(out + shortcut)
+    if out.is_cuda:
+        return _fused_residual_relu(out, shortcut)
+    # The JIT fuser does not run on CPU: update in place to avoid another allocation.
+    return F.relu_(out.add_(shortcut))
+
+
+def _conv(conv, x):
+    """
+    Apply `conv` to `x`. At inference, a 1x1 stride-1 conv on a channels_last input
+    is computed as a single GEMM over the NHWC pixels instead of a cuDNN convolution.
+    """
+    if (
+        not conv.training
+        and x.numel() > 0
+        and conv.kernel_size == (1, 1)
+        and conv.stride == (1, 1)
+        and conv.padding == (0, 0)
+        and conv.groups == 1
+        and x.is_contiguous(memory_format=torch.channels_last)
+    ):
+        # NCHW tensors in channels_last layout are NHWC in memory, so both permutes are views
+        x = F.linear(x.permute(0, 2, 3, 1), conv.weight.flatten(1), conv.bias)
+        x = x.permute(0, 3, 1, 2)
+        if conv.norm is not None:
+            x = conv.norm(x)
+        if conv.activation is not None:
+            x = conv.activation(x)
+        return x
+    return conv(x)
+
+
+def _c2_msra_fill(layers):
+    """
+    Same as `fvcore.nn.weight_init.c2_msra_fill` applied to each of `layers`, but the
+    weights of all layers are drawn from a single call to the random number generator.
+
+    Args:
+        layers (list[nn.Module or None]): conv layers. `None` entries are skipped.
+    """
+    layers = [layer for layer in layers if layer is not None]
+    with torch.no_grad():
+        noise = torch.randn(sum(layer.weight.numel() for layer in layers))
+        offset = 0
+        for layer in layers:
+            weight = layer.weight
+            # kaiming_normal_(mode="fan_out", nonlinearity="relu"): std = sqrt(2 / fan_out)
+            std = math.sqrt(2.0 / (weight.size(0) * weight[0][0].numel()))
+            weight.copy_(noise[offset : offset + weight.numel()].view(weight.shape) * std)
+            offset += weight.numel()
+            if layer.bias is not None:
+                layer.bias.zero_()
+
+
+def _use_cudnn_fusion(conv, x):
+    """
+    Whether `conv` followed by a ReLU can run as one fused cuDNN call. This needs
+    PyTorch >= 1.8, a conv without norm (see :meth:`ResNet.fuse_bn`), inference
+    without autograd since the fused ops have no backward, and no autocast.
+    """
+    return (
+        not conv.training
+        and not torch.is_grad_enabled()
+        and conv.norm is None
+        and conv.activation is None
+        and conv.padding_mode == "zeros"
+        and x.is_cuda
+        and x.numel() > 0
+        and x.dtype == conv.weight.dtype
+        and torch.backends.cudnn.enabled
+        and hasattr(torch, "cudnn_convolution_relu")
+        # The fused ops are not autocast ops: they would run, and return, in fp32
+        and not torch.is_autocast_enabled()
+    )
+
+
+def _conv_relu(conv, x):
+    """
+    Compute `relu(conv(x))`.
+    """
+    if _use_cudnn_fusion(conv, x):
+        return torch.cudnn_convolution_relu(
+            x, conv.weight, conv.bias, conv.stride, conv.padding, conv.dilation, conv.groups
+        )
+    return F.relu_(_conv(conv, x))
+
+
+def _conv_add_relu(conv, x, shortcut):
+    """
+    Compute `relu(conv(x) + shortcut)`, the tail of a residual block.
+    """
+    if _use_cudnn_fusion(conv, x) and shortcut.dtype == x.dtype:
+        return torch.cudnn_convolution_add_relu(
+            x,
+            conv.weight,
+            shortcut,
+            1.0,
+            conv.bias,
+            conv.stride,
+            conv.padding,
+            conv.dilation,
+            conv.groups,
+        )
+    return _residual_relu(_conv(conv, x), shortcut)
+
+
+def _fold_norm_into_conv(conv):
+    """
+    Fold the BatchNorm stored in `conv.norm` into the weight and bias of `conv`,
+    and remove the norm. Other kinds of norm (e.g. GN) are left untouched.
+
+    Args:
+        conv (Conv2d): a :class:`layers.Conv2d` with a norm.
+    """
+    norm = conv.norm
+    if isinstance(norm, (nn.BatchNorm2d, nn.SyncBatchNorm)):
+        if norm.training or norm.running_mean is None:
+            return
+    elif not isinstance(norm, FrozenBatchNorm2d):
+        return
+
+    with torch.no_grad():
+        running_var, running_mean = norm.running_var, norm.running_mean
+        weight = norm.weight if norm.weight is not None else torch.ones_like(running_var)
+        bias = norm.bias if norm.bias is not None else torch.zeros_like(running_mean)
+        scale = weight * (running_var + norm.eps).rsqrt()
+        conv_bias = conv.bias if conv.bias is not None else torch.zeros_like(running_mean)
+
+        conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+        conv.bias = nn.Parameter(
+            (conv_bias - running_mean) * scale + bias, requires_grad=conv.weight.requires_grad
+        )
+    conv.norm = None
+
+
 class BasicBlock(CNNBlockBase):
     """
     The basic residual block for ResNet-18 and ResNet-34 defined in :paper:`ResNet`,
@@ -80,22 +240,17 @@ class BasicBlock(CNNBlockBase):
             norm=get_norm(norm, out_channels),
         )
 
-        for layer in [self.conv1, self.conv2, self.shortcut]:
-            if layer is not None:  # shortcut can be None
-                weight_init.c2_msra_fill(layer)
+        _c2_msra_fill([self.conv1, self.conv2, self.shortcut])  # shortcut can be None
 
     def forward(self, x):
-        out = self.conv1(x)
-        out = F.relu_(out)
-        out = self.conv2(out)
+        out = _conv_relu(self.conv1, x)
 
         if self.shortcut is not None:
             shortcut = self.shortcut(x)
         else:
             shortcut = x
 
-        out += shortcut
-        out = F.relu_(out)
+        out = _conv_add_relu(self.conv2, out, shortcut)
         return out
 
 
@@ -215,13 +370,9 @@ class BottleneckBlock(CNNBlockBase):
         )
 
         if self.radix>1:
-            for layer in [self.conv1, self.conv3, self.shortcut]:
-                if layer is not None:  # shortcut can be None
-                    weight_init.c2_msra_fill(layer)
+            _c2_msra_fill([self.conv1, self.conv3, self.shortcut])  # shortcut can be None
         else:
-            for layer in [self.conv1, self.conv2, self.conv3, self.shortcut]:
-                if layer is not None:  # shortcut can be None
-                    weight_init.c2_msra_fill(layer)
+            _c2_msra_fill([self.conv1, self.conv2, self.conv3, self.shortcut])
 
         # Zero-initialize the last normalization in each residual branch,
         # so that at the beginning, the residual branch starts with zeros,
@@ -236,29 +387,24 @@ class BottleneckBlock(CNNBlockBase):
         # Add it as an option when we need to use this code to train a backbone.
 
     def forward(self, x):
-        out = self.conv1(x)
-        out = F.relu_(out)
+        out = _conv_relu(self.conv1, x)
 
         if self.radix>1:
             out = self.conv2(out)
         else:
-            out = self.conv2(out)
-            out = F.relu_(out)
+            out = _conv_relu(self.conv2, out)
 
         if self.avd:
             out = self.avd_layer(out)
 
-        out = self.conv3(out)
-
         if self.shortcut is not None:
             if self.avg_down:
                 x = self.shortcut_avgpool(x) 
-            shortcut = self.shortcut(x)
+            shortcut = _conv(self.shortcut, x)
         else:
             shortcut = x
 
-        out += shortcut
-        out = F.relu_(out)
+        out = _conv_add_relu(self.conv3, out, shortcut)
         return out
 
 
@@ -387,41 +533,40 @@ class DeformBottleneckBlock(CNNBlockBase):
         )
 
         if self.radix>1:
-            for layer in [self.conv1, self.conv3, self.shortcut]:
-                if layer is not None:  # shortcut can be None
-                    weight_init.c2_msra_fill(layer)
+            _c2_msra_fill([self.conv1, self.conv3, self.shortcut])  # shortcut can be None
         else:
-            for layer in [self.conv1, self.conv2, self.conv3, self.shortcut]:
-                if layer is not None:  # shortcut can be None
-                    weight_init.c2_msra_fill(layer)
+            _c2_msra_fill([self.conv1, self.conv2, self.conv3, self.shortcut])
 
         nn.init.constant_(self.conv2_offset.weight, 0)
         nn.init.constant_(self.conv2_offset.bias, 0)
 
     def forward(self, x):
-        out = self.conv1(x)
-        out = F.relu_(out)
-
-        if self.radix>1:
-            offset = self.conv2_offset(out)
-            out = self.conv2(out, offset)
+        out = _conv_relu(self.conv1, x)
+
+        # The deformable conv kernels only accept NCHW-contiguous tensors. Their weights and
+        # those of the offset conv are kept in NCHW (see `build_resnet_backbone`), and cuDNN
+        # follows the weight layout, so converting the input here is enough to get NCHW
+        # offsets, masks and deformable conv inputs.
+        channels_last = not out.is_contiguous() and out.is_contiguous(
+            memory_format=torch.channels_last
+        )
+        if channels_last:
+            out = out.contiguous()
+
+        if TORCH_VERSION >= (1, 6) and torch.is_autocast_enabled():
+            # The deformable conv kernels are not covered by autocast and require inputs
+            # of the same dtype as their fp32 weights
+            with torch.cuda.amp.autocast(enabled=False):
+                out = self._deform_conv2(out.float())
         else:
-            if self.deform_modulated:
-                offset_mask = self.conv2_offset(out)
-                offset_x, offset_y, mask = torch.chunk(offset_mask, 3, dim=1)
-                offset = torch.cat((offset_x, offset_y), dim=1)
-                mask = mask.sigmoid()
-                out = self.conv2(out, offset, mask)
-            else:
-                offset = self.conv2_offset(out)
-                out = self.conv2(out, offset)
-            out = F.relu_(out)
+            out = self._deform_conv2(out)
+
+        if channels_last:
+            out = out.contiguous(memory_format=torch.channels_last)
 
         if self.avd:
             out = self.avd_layer(out)
 
-        out = self.conv3(out)
-
         if self.shortcut is not None:
             if self.avg_down:
                 x = self.shortcut_avgpool(x) 
@@ -429,10 +574,29 @@ class DeformBottleneckBlock(CNNBlockBase):
         else:
             shortcut = x
 
-        out += shortcut
-        out = F.relu_(out)
+        out = _conv_add_relu(self.conv3, out, shortcut)
         return out
 
+    def _deform_conv2(self, out):
+        """
+        Compute the offsets from `out` and apply the deformable `conv2` to it.
+        """
+        if self.radix>1:
+            offset = self.conv2_offset(out)
+            return self.conv2(out, offset)
+        if self.deform_modulated:
+            offset_mask = self.conv2_offset(out)
+            # Same as chunk(offset_mask, 3) with x and y concatenated, but without a cat:
+            # the slice is already contiguous when the batch has a single image.
+            num_offsets = offset_mask.shape[1] // 3 * 2
+            offset = offset_mask[:, :num_offsets].contiguous()
+            mask = offset_mask[:, num_offsets:].sigmoid().contiguous()
+            out = self.conv2(out, offset, mask)
+        else:
+            offset = self.conv2_offset(out)
+            out = self.conv2(out, offset)
+        return F.relu_(out)
+
 
 class BasicStem(CNNBlockBase):
     def __init__(self, in_channels=3, out_channels=64, norm="BN",
@@ -465,9 +629,7 @@ class BasicStem(CNNBlockBase):
                                   padding=1, bias=False,
                                   norm=get_norm(norm, stem_width*2),
                                  ) 
-            for layer in [self.conv1_1, self.conv1_2, self.conv1_3]:
-                if layer is not None:  
-                    weight_init.c2_msra_fill(layer)
+            _c2_msra_fill([self.conv1_1, self.conv1_2, self.conv1_3])
 
             #As parameterized by original code : J
             self.in_channels = 3
@@ -488,19 +650,15 @@ class BasicStem(CNNBlockBase):
                 bias=False,
                 norm=get_norm(norm, out_channels),
             )
-            weight_init.c2_msra_fill(self.conv1)
+            _c2_msra_fill([self.conv1])
 
     def forward(self, x):
         if self.deep_stem:
-            x = self.conv1_1(x)
-            x = F.relu_(x)
-            x = self.conv1_2(x)
-            x = F.relu_(x)
-            x = self.conv1_3(x)
-            x = F.relu_(x)
+            x = _conv_relu(self.conv1_1, x)
+            x = _conv_relu(self.conv1_2, x)
+            x = _conv_relu(self.conv1_3, x)
         else:
-            x = self.conv1(x)
-            x = F.relu_(x)
+            x = _conv_relu(self.conv1, x)
         x = F.max_pool2d(x, kernel_size=3, stride=2, padding=1)
         return x
 
@@ -524,7 +682,16 @@ class ResNet(Backbone):
     Implement :paper:`ResNet`.
     """
 
-    def __init__(self, stem, stages, num_classes=None, out_features=None):
+    def __init__(
+        self,
+        stem,
+        stages,
+        num_classes=None,
+        out_features=None,
+        channels_last=False,
+        fp16=False,
+        cuda_graph=False,
+    ):
         """
         Args:
             stem (nn.Module): a stem module
@@ -535,10 +702,23 @@ class ResNet(Backbone):
             out_features (list[str]): name of the layers whose outputs should
                 be returned in forward. Can be anything in "stem", "linear", or "res2" ...
                 If None, will return the output of the last layer.
+            channels_last (bool): if True, convert the input to channels_last (NHWC) memory
+                format so that all layers run in NHWC. The module itself should also be
+                converted with `.to(memory_format=torch.channels_last)`.
+            fp16 (bool): if True, run the forward under CUDA fp16 autocast in eval mode.
+                Parameters stay in fp32 and the returned features are cast back to fp32.
+                Deformable convs, which autocast does not support, run in fp32. Training
+                is unaffected, since it would need a GradScaler to avoid fp16 underflow.
+            cuda_graph (bool): if True, call :meth:`enable_cuda_graph` on the first input
+                seen at inference.
         """
         super().__init__()
         self.stem = stem
         self.num_classes = num_classes
+        self.channels_last = channels_last
+        self.fp16 = fp16
+        self.cuda_graph = cuda_graph
+        self._cuda_graph = None
 
         current_stride = self.stem.stride
         self._out_feature_strides = {"stem": current_stride}
@@ -547,8 +727,9 @@ class ResNet(Backbone):
         self.stages_and_names = []
         for i, blocks in enumerate(stages):
             assert len(blocks) > 0, len(blocks)
-            for block in blocks:
-                assert isinstance(block, CNNBlockBase), block
+            if __debug__:  # skip the loop together with the asserts under `python -O`
+                for block in blocks:
+                    assert isinstance(block, CNNBlockBase), block
 
             name = "res" + str(i + 2)
             stage = nn.Sequential(*blocks)
@@ -556,8 +737,8 @@ class ResNet(Backbone):
             self.add_module(name, stage)
             self.stages_and_names.append((stage, name))
 
-            self._out_feature_strides[name] = current_stride = int(
-                current_stride * np.prod([k.stride for k in blocks])
+            self._out_feature_strides[name] = current_stride = current_stride * reduce(
+                operator.mul, (k.stride for k in blocks), 1
             )
             self._out_feature_channels[name] = curr_channels = blocks[-1].out_channels
 
@@ -579,21 +760,58 @@ class ResNet(Backbone):
         for out_feature in self._out_features:
             assert out_feature in children, "Available children: {}".format(", ".join(children))
 
+        # Precompute which stages produce an output, so that forward() does not
+        # look up names, and does not run stages after the last requested output.
+        self._stem_is_output = "stem" in self._out_features
+        self._linear_is_output = "linear" in self._out_features
+        self._stages_to_run = [
+            (stage, name, name in self._out_features) for stage, name in self.stages_and_names
+        ]
+        if not self._linear_is_output:
+            last = max(
+                [-1] + [i for i, (_, _, is_output) in enumerate(self._stages_to_run) if is_output]
+            )
+            self._stages_to_run = self._stages_to_run[: last + 1]
+
     def forward(self, x):
+        if self.cuda_graph and x.is_cuda and not self.training and not torch.is_grad_enabled():
+            if self._cuda_graph is None:
+                self.enable_cuda_graph(x)
+            graph, static_input, static_outputs = self._cuda_graph
+            if (
+                x.shape == static_input.shape
+                and x.dtype == static_input.dtype
+                and x.device == static_input.device
+            ):
+                static_input.copy_(x)
+                graph.replay()
+                # The static outputs are overwritten by the next replay
+                return {k: v.clone() for k, v in static_outputs.items()}
+        return self._eager_forward(x)
+
+    def _eager_forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.fp16 and not self.training:
+            with torch.cuda.amp.autocast():
+                outputs = self._forward(x)
+            return {k: v.float() for k, v in outputs.items()}
+        return self._forward(x)
+
+    def _forward(self, x):
         outputs = {}
         x = self.stem(x)
-        if "stem" in self._out_features:
+        if self._stem_is_output:
             outputs["stem"] = x
-        for stage, name in self.stages_and_names:
+        for stage, name, is_output in self._stages_to_run:
             x = stage(x)
-            if name in self._out_features:
+            if is_output:
                 outputs[name] = x
-        if self.num_classes is not None:
+        if self._linear_is_output:
             x = self.avgpool(x)
             x = torch.flatten(x, 1)
             x = self.linear(x)
-            if "linear" in self._out_features:
-                outputs["linear"] = x
+            outputs["linear"] = x
         return outputs
 
     def output_shape(self):
@@ -620,12 +838,66 @@ class ResNet(Backbone):
         Returns:
             nn.Module: this ResNet itself
         """
-        if freeze_at >= 1:
-            self.stem.freeze()
-        for idx, (stage, _) in enumerate(self.stages_and_names, start=2):
-            if freeze_at >= idx:
-                for block in stage.children():
-                    block.freeze()
+        frozen = [self.stem] if freeze_at >= 1 else []
+        frozen += [
+            stage
+            for idx, (stage, _) in enumerate(self.stages_and_names, start=2)
+            if freeze_at >= idx
+        ]
+        # Same as calling `freeze()` on the stem and on every block, in one pass per stage
+        for module in frozen:
+            for p in module.parameters():
+                p.requires_grad_(False)
+            FrozenBatchNorm2d.convert_frozen_batchnorm(module)
+        return self
+
+    def enable_cuda_graph(self, sample_input):
+        """
+        Capture the inference forward pass on `sample_input` into a CUDA graph.
+        Later calls to :meth:`forward` in eval mode, with autograd disabled and with an
+        input of the same shape, dtype and device, copy the input into a static buffer
+        and replay the graph instead of launching every kernel from Python.
+        Other inputs run eagerly. Requires PyTorch >= 1.10.
+
+        Args:
+            sample_input (Tensor): a CUDA tensor with the input shape to capture.
+
+        Returns:
+            nn.Module: this ResNet itself
+        """
+        assert TORCH_VERSION >= (1, 10), "CUDA graphs require PyTorch >= 1.10"
+        assert sample_input.is_cuda, "CUDA graphs require a CUDA input"
+        with torch.no_grad():
+            static_input = sample_input.clone()
+            # Warm up on a side stream before capture, e.g. for cuDNN autotuning
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._eager_forward(static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_outputs = self._eager_forward(static_input)
+        self._cuda_graph = (graph, static_input, static_outputs)
+        self.cuda_graph = True
+        return self
+
+    def fuse_bn(self):
+        """
+        Fold every BatchNorm (in eval mode) or FrozenBatchNorm that follows a :class:`Conv2d`
+        into the weight and bias of that conv, which removes one op per conv at inference.
+
+        This is for inference only: it should be called after the weights are loaded,
+        and the resulting state_dict no longer matches the one of the unfused model.
+
+        Returns:
+            nn.Module: this ResNet itself
+        """
+        for module in self.modules():
+            if isinstance(module, Conv2d) and module.norm is not None:
+                _fold_norm_into_conv(module)
         return self
 
     @staticmethod
@@ -687,19 +959,27 @@ def build_resnet_backbone(cfg, input_shape):
     """
 
     depth = cfg.MODEL.RESNETS.DEPTH
-    stem_width = {50: 32, 101: 64, 152: 64, 200: 64, 269: 64}[depth] 
+    stem_width = {18: 32, 34: 32, 50: 32, 101: 64, 152: 64, 200: 64, 269: 64}[depth]
     radix = cfg.MODEL.RESNETS.RADIX 
     deep_stem = cfg.MODEL.RESNETS.DEEP_STEM or (radix > 1)
 
     # need registration of new blocks/stems?
     norm = cfg.MODEL.RESNETS.NORM
-    stem = BasicStem(
-        in_channels=input_shape.channels,
-        out_channels=cfg.MODEL.RESNETS.STEM_OUT_CHANNELS,
-        norm=norm,
-        deep_stem=deep_stem,
-        stem_width=stem_width,
-    )
+    if deep_stem and cfg.MODEL.RESNETS.STEM_FUSED:
+        # A single 7x7 conv with the output width of the deep stem
+        stem = BasicStem(
+            in_channels=input_shape.channels,
+            out_channels=stem_width * 2,
+            norm=norm,
+        )
+    else:
+        stem = BasicStem(
+            in_channels=input_shape.channels,
+            out_channels=cfg.MODEL.RESNETS.STEM_OUT_CHANNELS,
+            norm=norm,
+            deep_stem=deep_stem,
+            stem_width=stem_width,
+        )
 
     # fmt: off
     freeze_at           = cfg.MODEL.BACKBONE.FREEZE_AT
@@ -717,8 +997,20 @@ def build_resnet_backbone(cfg, input_shape):
     avd                 = cfg.MODEL.RESNETS.AVD or (radix > 1)
     avg_down            = cfg.MODEL.RESNETS.AVG_DOWN or (radix > 1)
     bottleneck_width    = cfg.MODEL.RESNETS.BOTTLENECK_WIDTH
+    channels_last       = cfg.MODEL.RESNETS.CHANNELS_LAST
+    compile_model       = cfg.MODEL.RESNETS.COMPILE
+    fp16                = cfg.MODEL.RESNETS.FP16
+    cuda_graph          = cfg.MODEL.RESNETS.CUDA_GRAPH
+    channels_last       = channels_last or fp16
     # fmt: on
     assert res5_dilation in {1, 2}, "res5_dilation cannot be {}.".format(res5_dilation)
+    assert (
+        not compile_model or TORCH_VERSION >= (2, 0)
+    ), "MODEL.RESNETS.COMPILE requires PyTorch >= 2.0"
+    assert not fp16 or TORCH_VERSION >= (1, 6), "MODEL.RESNETS.FP16 requires PyTorch >= 1.6"
+    assert (
+        not cuda_graph or TORCH_VERSION >= (1, 10)
+    ), "MODEL.RESNETS.CUDA_GRAPH requires PyTorch >= 1.10"
 
     num_blocks_per_stage = {
         18: [2, 2, 2, 2],
@@ -745,28 +1037,34 @@ def build_resnet_backbone(cfg, input_shape):
     out_stage_idx = [{"res2": 2, "res3": 3, "res4": 4, "res5": 5}[f] for f in out_features]
     max_stage_idx = max(out_stage_idx)
     in_channels = 2*stem_width if deep_stem else in_channels
-    for idx, stage_idx in enumerate(range(2, max_stage_idx + 1)):
-        dilation = res5_dilation if stage_idx == 5 else 1
-        first_stride = 1 if idx == 0 or (stage_idx == 5 and dilation == 2) else 2
-        stage_kargs = {
-            "num_blocks": num_blocks_per_stage[idx],
-            "first_stride": first_stride,
-            "in_channels": in_channels,
-            "out_channels": out_channels,
+
+    # Arguments shared by all stages. Only the per-stage ones are updated in the loop.
+    # Use BasicBlock for R18 and R34.
+    if depth in [18, 34]:
+        base_stage_kargs = {"block_class": BasicBlock, "norm": norm}
+    else:
+        base_stage_kargs = {
             "norm": norm,
+            "stride_in_1x1": stride_in_1x1,
+            "num_groups": num_groups,
             "avd": avd,
             "avg_down": avg_down,
             "radix": radix,
             "bottleneck_width": bottleneck_width,
         }
-        # Use BasicBlock for R18 and R34.
-        if depth in [18, 34]:
-            stage_kargs["block_class"] = BasicBlock
-        else:
+    for idx, stage_idx in enumerate(range(2, max_stage_idx + 1)):
+        dilation = res5_dilation if stage_idx == 5 else 1
+        first_stride = 1 if idx == 0 or (stage_idx == 5 and dilation == 2) else 2
+        stage_kargs = dict(
+            base_stage_kargs,
+            num_blocks=num_blocks_per_stage[idx],
+            first_stride=first_stride,
+            in_channels=in_channels,
+            out_channels=out_channels,
+        )
+        if depth not in [18, 34]:
             stage_kargs["bottleneck_channels"] = bottleneck_channels
-            stage_kargs["stride_in_1x1"] = stride_in_1x1
             stage_kargs["dilation"] = dilation
-            stage_kargs["num_groups"] = num_groups
             if deform_on_per_stage[idx]:
                 stage_kargs["block_class"] = DeformBottleneckBlock
                 stage_kargs["deform_modulated"] = deform_modulated
@@ -778,4 +1076,30 @@ def build_resnet_backbone(cfg, input_shape):
         out_channels *= 2
         bottleneck_channels *= 2
         stages.append(blocks)
-    return ResNet(stem, stages, out_features=out_features).freeze(freeze_at)
+    model = ResNet(
+        stem,
+        stages,
+        out_features=out_features,
+        channels_last=channels_last,
+        fp16=fp16,
+        cuda_graph=cuda_graph,
+    )
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        # The deformable conv kernels require NCHW-contiguous weights
+        for module in model.modules():
+            if isinstance(module, DeformBottleneckBlock):
+                for p in chain(module.conv2_offset.parameters(), module.conv2.parameters()):
+                    p.data = p.data.contiguous()
+    model.freeze(freeze_at)
+    if compile_model:
+        global _compile_enabled
+        _compile_enabled = True
+        # Every stage and every input size is specialized separately.
+        _dynamo.config.cache_size_limit = max(_dynamo.config.cache_size_limit, 8192)
+        # Only compile forward() so that the module, its attributes and
+        # its state_dict keys remain the ones of a plain ResNet.
+        model.forward = torch.compile(
+            model.forward, mode="reduce-overhead", fullgraph=False, dynamic=False
+        )
+    return model
@@ -148,9 +148,9 @@ class SplAtConv2d_dcn(Module):
     def forward(self, x, offset_input):
 
         if self.deform_modulated: 
-            offset_x, offset_y, mask = torch.chunk(offset_input, 3, dim=1)
-            offset = torch.cat((offset_x, offset_y), dim=1)
-            mask = mask.sigmoid() 
+            num_offsets = offset_input.shape[1] // 3 * 2
+            offset = offset_input[:, :num_offsets].contiguous()
+            mask = offset_input[:, num_offsets:].sigmoid().contiguous()
             x = self.conv(x, offset, mask)
         else:
             x = self.conv(x, offset_input)
@@ -2,6 +2,7 @@
 import logging
 import torch
 import math
+from typing import Tuple
 
 from fvcore.nn import smooth_l1_loss, giou_loss
 from torch import nn
@@ -15,7 +16,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from detectron2.config import configurable
-from detectron2.layers import Linear, ShapeSpec, batched_nms, cat, nonzero_tuple
+from detectron2.layers import Linear, ShapeSpec, cat, nms, nonzero_tuple
 from detectron2.modeling.box_regression import Box2BoxTransform
 from detectron2.structures import Boxes, Instances
 from detectron2.utils.events import get_event_storage
@@ -47,7 +48,8 @@ Naming convention:
 
 def fast_rcnn_inference(boxes, scores, image_shapes, score_thresh, nms_thresh, topk_per_image):
     """
-    Call `fast_rcnn_inference_single_image` for all images.
+    Return bounding-box detection results of all images by thresholding on scores and
+    applying non-maximum suppression (NMS). All images are processed in one batch.
     Args:
         boxes (list[Tensor]): A list of Tensors of predicted class-specific or class-agnostic
             boxes for each image. Element i has shape (Ri, K * 4) if doing
@@ -69,13 +71,106 @@ def fast_rcnn_inference(boxes, scores, image_shapes, score_thresh, nms_thresh, t
         kept_indices: (list[Tensor]): A list of 1D tensor of length of N, each element indicates
             the corresponding boxes/scores index in [0, Ri) from the input, for image i.
     """
-    result_per_image = [
-        fast_rcnn_inference_single_image(
-            boxes_per_image, scores_per_image, image_shape, score_thresh, nms_thresh, topk_per_image
-        )
-        for scores_per_image, boxes_per_image, image_shape in zip(scores, boxes, image_shapes)
-    ]
-    return [x[0] for x in result_per_image], [x[1] for x in result_per_image]
+    if len(scores) == 0:
+        return [], []
+    num_preds_per_image = [len(s) for s in scores]
+    return _fast_rcnn_inference_batched(
+        cat(list(boxes)),
+        cat(list(scores)),
+        num_preds_per_image,
+        image_shapes,
+        score_thresh,
+        nms_thresh,
+        topk_per_image,
+    )
+
+
+def _fast_rcnn_inference_batched(
+    boxes, scores, num_preds_per_image, image_shapes, score_thresh, nms_thresh, topk_per_image
+):
+    """
+    Same as `fast_rcnn_inference`, but with the predictions of all images concatenated
+    along the first dimension. Thresholding and NMS run once for the whole batch: each
+    (image, class) pair gets its own NMS group, so boxes of different images never
+    suppress each other.
+    Args:
+        boxes (Tensor): (R, K * 4) or (R, 4) predicted boxes of all images.
+        scores (Tensor): (R, K + 1) predicted class scores of all images.
+        num_preds_per_image (list[int]): the number of predictions Ri of each image.
+        Others are the same as `fast_rcnn_inference`.
+    Returns:
+        Same as `fast_rcnn_inference`.
+    """
+    device = scores.device
+    num_images = len(num_preds_per_image)
+    image_inds = torch.repeat_interleave(
+        torch.arange(num_images, device=device),
+        torch.as_tensor(num_preds_per_image, device=device),
+    )
+
+    valid_mask = torch.isfinite(torch.cat([boxes, scores], dim=1)).all(dim=1)
+    scores = scores[:, :-1]
+    num_bbox_reg_classes = boxes.shape[1] // 4
+    boxes = boxes.reshape(-1, num_bbox_reg_classes, 4)  # R x C x 4
+    # Same as `Boxes.clip`, with every row clipped to the size of its own image
+    image_sizes = torch.as_tensor(image_shapes, dtype=boxes.dtype, device=device)  # N x (h, w)
+    max_coords = image_sizes.flip(1).repeat(1, 2)[image_inds]  # R x (w, h, w, h)
+    boxes = torch.min(boxes.clamp(min=0), max_coords[:, None, :])
+
+    # Filter results based on detection scores. Rows with non-finite predictions are
+    # dropped here, which keeps the returned indices relative to the input rows.
+    filter_mask = (scores > score_thresh) & valid_mask[:, None]  # R x K
+    # R' indices of the R predictions, and R' indices of classes.
+    row_inds, class_inds = nonzero_tuple(filter_mask)
+    boxes = boxes[row_inds, 0 if num_bbox_reg_classes == 1 else class_inds]
+    scores = scores[row_inds, class_inds]
+    image_inds = image_inds[row_inds]
+
+    # Apply per-class NMS within each image.
+    keep = _batched_nms_coordinate_trick(boxes, scores, class_inds, nms_thresh, image_inds)
+    # `keep` is sorted by decreasing score. Group it by image without changing the order
+    # within each image, so that the top-k of an image is a prefix of its group.
+    order = torch.arange(len(keep), device=device)
+    keep = keep[torch.argsort(image_inds[keep] * len(keep) + order)]
+    num_kept_per_image = torch.bincount(image_inds[keep], minlength=num_images).tolist()
+
+    results, kept_indices = [], []
+    offset = 0
+    for keep_i, num_preds, image_shape in zip(
+        keep.split(num_kept_per_image), num_preds_per_image, image_shapes
+    ):
+        if topk_per_image >= 0:
+            keep_i = keep_i[:topk_per_image]
+        result = Instances(image_shape)
+        result.pred_boxes = Boxes(boxes[keep_i])
+        result.scores = scores[keep_i]
+        result.pred_classes = class_inds[keep_i]
+        results.append(result)
+        kept_indices.append(row_inds[keep_i] - offset)
+        offset += num_preds
+    return results, kept_indices
+
+
+def _batched_nms_coordinate_trick(boxes, scores, idxs, iou_threshold, image_inds=None):
+    """
+    Same as :func:`detectron2.layers.batched_nms`, but always offsets the boxes of each
+    group so that groups cannot overlap and runs a single `nms`, instead of looping
+    over the groups in Python when there are many boxes.
+
+    If `image_inds` is given, boxes are grouped by (image, idxs) pairs. The class offset
+    is applied along x and the image offset along y, so that the offsets, and the
+    float32 rounding of the shifted coordinates, grow with max(N, K) rather than N * K.
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    max_coordinate = boxes.max()
+    offsets = idxs.to(boxes) * (max_coordinate + 1)
+    if image_inds is None:
+        offsets = offsets[:, None]
+    else:
+        offsets_y = image_inds.to(boxes) * (max_coordinate + 1)
+        offsets = torch.stack([offsets, offsets_y, offsets, offsets_y], dim=1)
+    return nms(boxes + offsets, scores, iou_threshold)
 
 
 def fast_rcnn_inference_single_image(
@@ -90,46 +185,193 @@ def fast_rcnn_inference_single_image(
     Returns:
         Same as `fast_rcnn_inference`, but for only one image.
     """
-    valid_mask = torch.isfinite(boxes).all(dim=1) & torch.isfinite(scores).all(dim=1)
-    if not valid_mask.all():
-        boxes = boxes[valid_mask]
-        scores = scores[valid_mask]
-
+    valid_mask = torch.isfinite(torch.cat([boxes, scores], dim=1)).all(dim=1)
     scores = scores[:, :-1]
     num_bbox_reg_classes = boxes.shape[1] // 4
-    # Convert to Boxes to use the `clip` function ...
-    boxes = Boxes(boxes.reshape(-1, 4))
-    boxes.clip(image_shape)
-    boxes = boxes.tensor.view(-1, num_bbox_reg_classes, 4)  # R x C x 4
-
-    # Filter results based on detection scores
-    filter_mask = scores > score_thresh  # R x K
-    # R' x 2. First column contains indices of the R predictions;
-    # Second column contains indices of classes.
-    filter_inds = filter_mask.nonzero()
-    if num_bbox_reg_classes == 1:
-        boxes = boxes[filter_inds[:, 0], 0]
-    else:
-        boxes = boxes[filter_mask]
-    scores = scores[filter_mask]
+    boxes = boxes.reshape(-1, num_bbox_reg_classes, 4)  # R x C x 4
+    # Same as `Boxes.clip`, which cannot be used here because it asserts that all boxes
+    # are finite; the non-finite ones are only dropped by the score filter below.
+    h, w = image_shape
+    x = boxes[..., 0::2].clamp(min=0, max=w)
+    y = boxes[..., 1::2].clamp(min=0, max=h)
+    boxes = torch.stack([x[..., 0], y[..., 0], x[..., 1], y[..., 1]], dim=-1)
+
+    # Filter results based on detection scores. Rows with non-finite predictions are
+    # dropped here rather than up front, so no host sync is needed to check for them.
+    filter_mask = (scores > score_thresh) & valid_mask[:, None]  # R x K
+    # R' indices of the R predictions, and R' indices of classes.
+    row_inds, class_inds = nonzero_tuple(filter_mask)
+    boxes = boxes[row_inds, 0 if num_bbox_reg_classes == 1 else class_inds]
+    scores = scores[row_inds, class_inds]
 
     # Apply per-class NMS.
-    keep = batched_nms(boxes, scores, filter_inds[:, 1], nms_thresh)
+    keep = _batched_nms_coordinate_trick(boxes, scores, class_inds, nms_thresh)
     # DIOU NMS commented for now
-    # keep = batched_diou_nms(boxes, scores, filter_inds[:, 1], nms_thresh) \
+    # keep = batched_diou_nms(boxes, scores, class_inds, nms_thresh) \
     #        if global_cfg.MODEL.ROI_BOX_HEAD.NMS_TYPE == "diou_nms" \
     #        else \
-    #        batched_nms(boxes, scores, filter_inds[:, 1], nms_thresh)
+    #        batched_nms(boxes, scores, class_inds, nms_thresh)
 
     if topk_per_image >= 0:
         keep = keep[:topk_per_image]
-    boxes, scores, filter_inds = boxes[keep], scores[keep], filter_inds[keep]
 
     result = Instances(image_shape)
-    result.pred_boxes = Boxes(boxes)
-    result.scores = scores
-    result.pred_classes = filter_inds[:, 1]
-    return result, filter_inds[:, 0]
+    result.pred_boxes = Boxes(boxes[keep])
+    result.scores = scores[keep]
+    result.pred_classes = class_inds[keep]
+    return result, row_inds[keep]
+
+
+# Cache of box2box weights as (2, 2) tensors, see `_delta_weights`
+_DELTA_WEIGHTS = {}
+
+
+def _delta_weights(weights, device, dtype):
+    """
+    Returns:
+        Tensor: the (wx, wy, ww, wh) weights as a [[wx, wy], [ww, wh]] tensor on the given
+            device, created once per (weights, device, dtype).
+    """
+    key = (tuple(weights), device, dtype)
+    weights_tensor = _DELTA_WEIGHTS.get(key)
+    if weights_tensor is None:
+        weights_tensor = _DELTA_WEIGHTS[key] = torch.tensor(
+            weights, dtype=dtype, device=device
+        ).view(2, 2)
+    return weights_tensor
+
+
+@torch.jit.script
+def _bbox_transform(
+    deltas, weights, scale_clamp: float
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Convert (dx, dy, dw, dh) deltas to (x1, y1, x2, y2) coordinates in delta space,
+    i.e. of a unit box centered at the origin. Used by the DIoU and CIoU losses.
+    `weights` is the [[wx, wy], [ww, wh]] tensor returned by `_delta_weights`.
+    """
+    # Every row is ((dx, dy), (dw, dh)), so that each step below is one op over all boxes
+    deltas = deltas.reshape(-1, 2, 2) / weights
+    pred_ctr = deltas[:, 0]
+    pred_size = torch.exp(torch.clamp(deltas[:, 1], max=scale_clamp))
+
+    x1, y1 = (pred_ctr - 0.5 * pred_size).unbind(1)
+    x2, y2 = (pred_ctr + 0.5 * pred_size).unbind(1)
+    return x1, y1, x2, y2
+
+
+@torch.jit.script
+def _diou_loss(
+    deltas, target_deltas, weights: Tuple[float, float, float, float], scale_clamp: float
+):
+    """
+    Per-box DIoU loss, 1 - DIoU, between (R, 4) predicted and target deltas. The deltas
+    are decoded as boxes relative to a unit box at the origin (see `_bbox_transform`).
+    Everything is computed on the (R,) columns of the inputs in one pointwise chain
+    so that the JIT can fuse it into a single kernel.
+    """
+    wx, wy, ww, wh = weights
+    x_p = deltas[:, 0] / wx
+    y_p = deltas[:, 1] / wy
+    w_p = torch.exp(torch.clamp(deltas[:, 2] / ww, max=scale_clamp))
+    h_p = torch.exp(torch.clamp(deltas[:, 3] / wh, max=scale_clamp))
+    x_g = target_deltas[:, 0] / wx
+    y_g = target_deltas[:, 1] / wy
+    w_g = torch.exp(torch.clamp(target_deltas[:, 2] / ww, max=scale_clamp))
+    h_g = torch.exp(torch.clamp(target_deltas[:, 3] / wh, max=scale_clamp))
+
+    x1 = x_p - 0.5 * w_p
+    y1 = y_p - 0.5 * h_p
+    x2 = x_p + 0.5 * w_p
+    y2 = y_p + 0.5 * h_p
+    x1g = x_g - 0.5 * w_g
+    y1g = y_g - 0.5 * h_g
+    x2g = x_g + 0.5 * w_g
+    y2g = y_g + 0.5 * h_g
+
+    #Instersction of two boxes. Not clamped at zero, as in the original DIoU loss code
+    intsctk = (torch.min(x2, x2g) - torch.max(x1, x1g)) * (
+        torch.min(y2, y2g) - torch.max(y1, y1g)
+    )
+
+    #Union of two boxes
+    unionk = w_p * h_p + w_g * h_g - intsctk + 1e-7
+    iouk = intsctk / unionk
+
+    #Note both of the below distances do not use square root.
+    #As per the authors advice the gradient would have to calculate square
+    #root as well. Hence it hasn't been used here.
+    #Length of largest diagonal of the polygon covering both boxes.
+    c = (
+        ((torch.max(x2, x2g) - torch.min(x1, x1g)) ** 2)
+        + ((torch.max(y2, y2g) - torch.min(y1, y1g)) ** 2)
+        + 1e-7
+    )
+    #Distance between center points.
+    d = ((x_p - x_g) ** 2) + ((y_p - y_g) ** 2)
+    return 1 - iouk + d / c
+
+
+@torch.jit.script
+def _ciou_loss(x1, y1, x2, y2, x1g, y1g, x2g, y2g):
+    """
+    Per-box CIoU loss, 1 - CIoU, between predicted boxes (x1, y1, x2, y2) and
+    target boxes (x1g, y1g, x2g, y2g).
+    """
+    x2 = torch.max(x1, x2)
+    y2 = torch.max(y1, y2)
+    w_pred = x2 - x1
+    h_pred = y2 - y1
+    w_gt = x2g - x1g
+    h_gt = y2g - y1g
+
+    x_center = (x2 + x1) / 2
+    y_center = (y2 + y1) / 2
+    x_center_g = (x1g + x2g) / 2
+    y_center_g = (y1g + y2g) / 2
+
+    xkis1 = torch.max(x1, x1g)
+    ykis1 = torch.max(y1, y1g)
+    xkis2 = torch.min(x2, x2g)
+    ykis2 = torch.min(y2, y2g)
+
+    xc1 = torch.min(x1, x1g)
+    yc1 = torch.min(y1, y1g)
+    xc2 = torch.max(x2, x2g)
+    yc2 = torch.max(y2, y2g)
+
+    intsctk = (xkis2 - xkis1).clamp(min=0) * (ykis2 - ykis1).clamp(min=0)
+    unionk = (x2 - x1) * (y2 - y1) + (x2g - x1g) * (y2g - y1g) - intsctk + 1e-7
+    iouk = intsctk / unionk
+
+    c = ((xc2 - xc1) ** 2) + ((yc2 - yc1) ** 2) + 1e-7
+    d = ((x_center - x_center_g) ** 2) + ((y_center - y_center_g) ** 2)
+    u = d / c
+
+    # atan(w_gt / h_gt) - atan(w_pred / h_pred) as a single atan2; the identity
+    # atan(a) - atan(b) = atan2(a - b, 1 + ab) holds since all sizes are positive
+    v = (4 / (math.pi ** 2)) * torch.pow(
+        torch.atan2(w_gt * h_pred - w_pred * h_gt, h_gt * h_pred + w_gt * w_pred), 2
+    )
+    # alpha is a trade-off weight and is not back-propagated through
+    alpha = (v / (1 - iouk + v)).detach()
+    return 1 - (iouk - (u + alpha * v))
+
+
+# Cache of (0, 4) tensors, one per device, see `_empty_boxes`
+_EMPTY_BOXES = {}
+
+
+def _empty_boxes(device):
+    """
+    Returns:
+        Tensor: an empty (0, 4) box tensor on the given device. It has no elements, so
+            a single instance can safely be shared by all empty batches.
+    """
+    boxes = _EMPTY_BOXES.get(device)
+    if boxes is None:
+        boxes = _EMPTY_BOXES[device] = torch.zeros(0, 4, device=device)
+    return boxes
 
 
 class FastRCNNOutputs:
@@ -196,13 +438,65 @@ class FastRCNNOutputs:
                 assert proposals[0].has("gt_classes")
                 self.gt_classes = cat([p.gt_classes for p in proposals], dim=0)
         else:
-            self.proposals = Boxes(torch.zeros(0, 4, device=self.pred_proposal_deltas.device))
+            self.proposals = Boxes(_empty_boxes(self.pred_proposal_deltas.device))
 
         #Get global configuration. Will work on improving this later
         self.cfg = global_cfg
 
         self._no_instances = len(proposals) == 0  # no instances found
 
+        # Computed on first use and shared by the losses, see `_fg_selection`,
+        # `_get_gt_deltas` and `_predict_boxes`
+        self._fg_inds = None
+        self._gt_deltas = None
+        self._predicted_boxes = None
+
+    def _fg_selection(self):
+        """
+        Returns:
+            Tensor: indices of the foreground proposals, whose gt class k satisfies
+                0 <= k < bg_class_ind.
+        """
+        if self._fg_inds is None:
+            bg_class_ind = self.pred_class_logits.shape[1] - 1
+            self._fg_inds = nonzero_tuple(
+                (self.gt_classes >= 0) & (self.gt_classes < bg_class_ind)
+            )[0]
+        return self._fg_inds
+
+    def _get_gt_deltas(self):
+        """
+        Returns:
+            Tensor: ground-truth box2box transform deltas from the proposals to their
+                gt boxes, of shape (R, B).
+        """
+        if self._gt_deltas is None:
+            self._gt_deltas = self.box2box_transform.get_deltas(
+                self.proposals.tensor, self.gt_boxes.tensor
+            )
+        return self._gt_deltas
+
+    def _select_fg_gt_class(self, pred):
+        """
+        Args:
+            pred (Tensor): (R, K * B) or (R, B) class-specific or class-agnostic
+                predictions, e.g. deltas or boxes.
+        Returns:
+            Tensor: (Nfg, B) the predictions of the foreground proposals for their gt class.
+        """
+        box_dim = self.gt_boxes.tensor.size(1)  # 4 or 5
+        fg_inds = self._fg_selection()
+        if pred.size(1) == box_dim:
+            # pred only corresponds to foreground class for agnostic
+            return pred.index_select(0, fg_inds)
+        fg_gt_classes = self.gt_classes[fg_inds]
+        # pred for class k is located in columns [b * k : b * k + b],
+        # where b is the dimension of box representation (4 or 5)
+        # Note that compared to Detectron1,
+        # we do not perform bounding box regression for background classes.
+        num_classes = pred.size(1) // box_dim
+        return pred.reshape(-1, box_dim).index_select(0, fg_inds * num_classes + fg_gt_classes)
+
     def _log_accuracy(self):
         """
         Log the accuracy metrics to EventStorage.
@@ -211,14 +505,19 @@ class FastRCNNOutputs:
         pred_classes = self.pred_class_logits.argmax(dim=1)
         bg_class_ind = self.pred_class_logits.shape[1] - 1
 
-        fg_inds = (self.gt_classes >= 0) & (self.gt_classes < bg_class_ind)
-        num_fg = fg_inds.nonzero().numel()
+        fg_inds = self._fg_selection()
+        num_fg = fg_inds.numel()
         fg_gt_classes = self.gt_classes[fg_inds]
         fg_pred_classes = pred_classes[fg_inds]
 
-        num_false_negative = (fg_pred_classes == bg_class_ind).nonzero().numel()
-        num_accurate = (pred_classes == self.gt_classes).nonzero().numel()
-        fg_num_accurate = (fg_pred_classes == fg_gt_classes).nonzero().numel()
+        # Count everything on device and copy the counts to the host at once
+        num_false_negative, num_accurate, fg_num_accurate = torch.stack(
+            [
+                (fg_pred_classes == bg_class_ind).sum(),
+                (pred_classes == self.gt_classes).sum(),
+                (fg_pred_classes == fg_gt_classes).sum(),
+            ]
+        ).tolist()
 
         storage = get_event_storage()
         if num_instances > 0:
@@ -250,43 +549,24 @@ class FastRCNNOutputs:
         if self._no_instances:
             return 0.0 * self.pred_proposal_deltas.sum()
 
-        box_dim = self.gt_boxes.tensor.size(1)  # 4 or 5
-        cls_agnostic_bbox_reg = self.pred_proposal_deltas.size(1) == box_dim
-        device = self.pred_proposal_deltas.device
-
-        bg_class_ind = self.pred_class_logits.shape[1] - 1
-
         # Box delta loss is only computed between the prediction for the gt class k
         # (if 0 <= k < bg_class_ind) and the target; there is no loss defined on predictions
         # for non-gt classes and background.
         # Empty fg_inds produces a valid loss of zero as long as the size_average
         # arg to smooth_l1_loss is False (otherwise it uses torch.mean internally
         # and would produce a nan loss).
-        fg_inds = nonzero_tuple((self.gt_classes >= 0) & (self.gt_classes < bg_class_ind))[0]
-        if cls_agnostic_bbox_reg:
-            # pred_proposal_deltas only corresponds to foreground class for agnostic
-            gt_class_cols = torch.arange(box_dim, device=device)
-        else:
-            fg_gt_classes = self.gt_classes[fg_inds]
-            # pred_proposal_deltas for class k are located in columns [b * k : b * k + b],
-            # where b is the dimension of box representation (4 or 5)
-            # Note that compared to Detectron1,
-            # we do not perform bounding box regression for background classes.
-            gt_class_cols = box_dim * fg_gt_classes[:, None] + torch.arange(box_dim, device=device)
+        fg_inds = self._fg_selection()
 
         if self.box_reg_loss_type == "smooth_l1":
-            gt_proposal_deltas = self.box2box_transform.get_deltas(
-                self.proposals.tensor, self.gt_boxes.tensor
-            )
             loss_box_reg = smooth_l1_loss(
-                self.pred_proposal_deltas[fg_inds[:, None], gt_class_cols],
-                gt_proposal_deltas[fg_inds],
+                self._select_fg_gt_class(self.pred_proposal_deltas),
+                self._get_gt_deltas()[fg_inds],
                 self.smooth_l1_beta,
                 reduction="sum",
             )
         elif self.box_reg_loss_type == "giou":
             loss_box_reg = giou_loss(
-                self._predict_boxes()[fg_inds[:, None], gt_class_cols],
+                self._select_fg_gt_class(self._predict_boxes()),
                 self.gt_boxes.tensor[fg_inds],
                 reduction="sum",
             )
@@ -315,16 +595,13 @@ class FastRCNNOutputs:
     def compute_giou_fvcore(self):
 
         box_dim = self.gt_boxes.tensor.size(1)  # 4 or 5
-        device = self.pred_proposal_deltas.device
-        bg_class_ind = self.pred_class_logits.shape[1] - 1
-        gt_class_cols = torch.arange(box_dim, device=device)
 
         # set_trace()
 
-        fg_inds = nonzero_tuple((self.gt_classes >= 0) & (self.gt_classes < bg_class_ind))[0]
+        fg_inds = self._fg_selection()
 
         loss = giou_loss(
-                self._predict_boxes()[fg_inds[:, None], gt_class_cols],
+                self._predict_boxes()[fg_inds, :box_dim],
                 self.gt_boxes.tensor[fg_inds],
                 reduction="sum",
             )
@@ -400,96 +677,39 @@ class FastRCNNOutputs:
 
 
     def bbox_transform(self, deltas, weights):
-        wx, wy, ww, wh = weights
-        dx = deltas[:, 0::4] / wx
-        dy = deltas[:, 1::4] / wy
-        dw = deltas[:, 2::4] / ww
-        dh = deltas[:, 3::4] / wh
-
-        dw = torch.clamp(dw, max=self.box2box_transform.scale_clamp)
-        dh = torch.clamp(dh, max=self.box2box_transform.scale_clamp)
-
-        pred_ctr_x = dx
-        pred_ctr_y = dy
-        pred_w = torch.exp(dw)
-        pred_h = torch.exp(dh)
-
-        x1 = pred_ctr_x - 0.5 * pred_w
-        y1 = pred_ctr_y - 0.5 * pred_h
-        x2 = pred_ctr_x + 0.5 * pred_w
-        y2 = pred_ctr_y + 0.5 * pred_h
-
-        return x1.view(-1), y1.view(-1), x2.view(-1), y2.view(-1)
+        weights = _delta_weights(weights, deltas.device, deltas.dtype)
+        return _bbox_transform(deltas, weights, self.box2box_transform.scale_clamp)
 
     def compute_diou(self):
 
         #Note: This version of DIOU uses delta values instead of actual bboxes
         #I found delta values more efficient for our case
         output_delta = self.pred_proposal_deltas
-        target_delta = self.box2box_transform.get_deltas(
-                          self.proposals.tensor, self.gt_boxes.tensor
-        )
+        target_delta = self._get_gt_deltas()
 
         #Borrowed from sl1. Earlier verison used mask code
         #This section simply set's mask = True for those coordinates bounding boxes
         #which have an IOU above threshold (as per current Faster thr is 50, For
         #Cascade it is 50, 60. 70) with gt_boxes
-        bg_class_ind = self.pred_class_logits.shape[1] - 1
         box_dim = target_delta.size(1)  # 4 or 5
 
-        fg_inds = torch.nonzero(
-            (self.gt_classes >= 0) & (self.gt_classes < bg_class_ind), as_tuple=True
-        )[0]
+        fg_inds = self._fg_selection()
 
-        gt_class_cols = torch.arange(box_dim, device=self.pred_proposal_deltas.device)
-
-        output_delta = output_delta[fg_inds[:, None], gt_class_cols]
+        output_delta = output_delta[fg_inds, :box_dim]
         target_delta = target_delta[fg_inds]
 
         #Note: We use delta values here as per the orignal authors code
         #Delta values are : (center_x, center_y, w, h).
-        #Here the bbox_transform unlike Detectron2's Box2BoxTransform get_deltas converts
-        #the delta coordinates to x1, y1, x2, y2. These coordinates are still deltas but
-        #they are used in calculating DIOU loss and hence the bbox_transform function is still used
-        x1, y1, x2, y2 = self.bbox_transform(output_delta, self.box2box_transform.weights)
-        x1g, y1g, x2g, y2g = self.bbox_transform(target_delta, self.box2box_transform.weights)
-
-        x2 = torch.max(x1, x2)
-        y2 = torch.max(y1, y2)
-
-        x_p = (x2 + x1) / 2
-        y_p = (y2 + y1) / 2
-        x_g = (x1g + x2g) / 2
-        y_g = (y1g + y2g) / 2
-
-        xkis1 = torch.max(x1, x1g)
-        ykis1 = torch.max(y1, y1g)
-        xkis2 = torch.min(x2, x2g)
-        ykis2 = torch.min(y2, y2g)
-
-        xc1 = torch.min(x1, x1g)
-        yc1 = torch.min(y1, y1g)
-        xc2 = torch.max(x2, x2g)
-        yc2 = torch.max(y2, y2g)
-
-        #Instersction of two boxes
-        intsctk = (xkis2 - xkis1) * (ykis2 - ykis1)   #Optimized
-
-        #Union of two boxes
-        unionk = (x2 - x1) * (y2 - y1) + (x2g - x1g) * (y2g - y1g) - intsctk + 1e-7
-        iouk = intsctk / unionk
-
-        #Note both of the below distances do not use square root.
-        #As per the authors advice the gradient would have to calculate square
-        #root as well. Hence it hasn't been used here.
-        #Length of largest diagonal of the polygon covering both boxes.
-        c = ((xc2 - xc1) ** 2) + ((yc2 - yc1) ** 2) + 1e-7
-        #Distance between center points.
-        d = ((x_p - x_g) ** 2) + ((y_p - y_g) ** 2)
-        u = d / c
-        diouk = iouk - u
-
-        diouk = (1 - diouk).sum() / self.gt_classes.numel()
+        #Like bbox_transform, the loss decodes the delta coordinates to x1, y1, x2, y2.
+        #These coordinates are still deltas but they are used in calculating DIOU loss
+        diouk = _diou_loss(
+            output_delta,
+            target_delta,
+            self.box2box_transform.weights,
+            self.box2box_transform.scale_clamp,
+        )
+
+        diouk = diouk.sum() / self.gt_classes.numel()
         diouk = diouk * self.cfg.MODEL.ROI_BOX_HEAD.LOSS_BOX_WEIGHT
 
         return diouk
@@ -499,9 +719,7 @@ class FastRCNNOutputs:
     def compute_ciou(self):
 
         output = self.pred_proposal_deltas
-        target = self.box2box_transform.get_deltas(
-            self.proposals.tensor, self.gt_boxes.tensor
-        )
+        target = self._get_gt_deltas()
 
         x1, y1, x2, y2 = self.bbox_transform(output, self.box2box_transform.weights)
         x1g, y1g, x2g, y2g = self.bbox_transform(target, self.box2box_transform.weights)
@@ -522,53 +740,11 @@ class FastRCNNOutputs:
 
         # set_trace()
 
-        x2 = torch.max(x1, x2)
-        y2 = torch.max(y1, y2)
-        # assert (x2 >= x1).all(), "bad box: x1 larger than x2"
-        # assert (y2 >= y1).all(), "bad box: y1 larger than y2"
-        w_pred = x2 - x1
-        h_pred = y2 - y1
-        w_gt = x2g - x1g
-        h_gt = y2g - y1g
-
-        x_center = (x2 + x1) / 2
-        y_center = (y2 + y1) / 2
-        x_center_g = (x1g + x2g) / 2
-        y_center_g = (y1g + y2g) / 2
-
-        xkis1 = torch.max(x1, x1g)
-        ykis1 = torch.max(y1, y1g)
-        xkis2 = torch.min(x2, x2g)
-        ykis2 = torch.min(y2, y2g)
-
-        xc1 = torch.min(x1, x1g)
-        yc1 = torch.min(y1, y1g)
-        xc2 = torch.max(x2, x2g)
-        yc2 = torch.max(y2, y2g)
-
-        intsctk = torch.zeros_like(x1)
-        mask = (ykis2 > ykis1) * (xkis2 > xkis1)
-        intsctk[mask] = (xkis2[mask] - xkis1[mask]) * (ykis2[mask] - ykis1[mask])
-        unionk = (x2 - x1) * (y2 - y1) + (x2g - x1g) * (y2g - y1g) - intsctk + 1e-7
-        iouk = intsctk / unionk
-
-        c = ((xc2 - xc1) ** 2) + ((yc2 - yc1) ** 2) + 1e-7
-        d = ((x_center - x_center_g) ** 2) + ((y_center - y_center_g) ** 2)
-        u = d / c
-
-        v = (4 / (math.pi ** 2)) * torch.pow((torch.atan(w_gt / h_gt) - torch.atan(w_pred / h_pred)), 2)
-        with torch.no_grad():
-            S = 1 - iouk
-            alpha = v / (S + v)
-        ciouk = iouk - (u + alpha * v)
+        ciouk = _ciou_loss(x1, y1, x2, y2, x1g, y1g, x2g, y2g)
 
-        bg_class_ind = self.pred_class_logits.shape[1] - 1
-
-        fg_inds = torch.nonzero(
-            (self.gt_classes >= 0) & (self.gt_classes < bg_class_ind), as_tuple=True
-        )[0]
+        fg_inds = self._fg_selection()
 
-        ciouk = (1 - ciouk[fg_inds]).sum() / self.gt_classes.numel()
+        ciouk = ciouk[fg_inds].sum() / self.gt_classes.numel()
 
         ciouk = ciouk * self.cfg.MODEL.ROI_BOX_HEAD.LOSS_BOX_WEIGHT
 
@@ -584,7 +760,11 @@ class FastRCNNOutputs:
                 for all images in a batch. Element i has shape (Ri, K * B) or (Ri, B), where Ri is
                 the number of predicted objects for image i and B is the box dimension (4 or 5)
         """
-        return self.box2box_transform.apply_deltas(self.pred_proposal_deltas, self.proposals.tensor)
+        if self._predicted_boxes is None:
+            self._predicted_boxes = self.box2box_transform.apply_deltas(
+                self.pred_proposal_deltas, self.proposals.tensor
+            )
+        return self._predicted_boxes
 
     """
     A subclass is expected to have the following methods because
@@ -642,11 +822,16 @@ class FastRCNNOutputs:
         """
         Deprecated
         """
-        boxes = self.predict_boxes()
-        scores = self.predict_probs()
-        image_shapes = self.image_shapes
-        return fast_rcnn_inference(
-            boxes, scores, image_shapes, score_thresh, nms_thresh, topk_per_image
+        if self._no_instances:
+            return [], []
+        return _fast_rcnn_inference_batched(
+            self._predict_boxes(),
+            F.softmax(self.pred_class_logits, dim=-1),
+            self.num_preds_per_image,
+            self.image_shapes,
+            score_thresh,
+            nms_thresh,
+            topk_per_image,
         )
 
 
@@ -703,6 +888,9 @@ class FastRCNNOutputLayers(nn.Module):
         nn.init.normal_(self.bbox_pred.weight, std=0.001)
         for l in [self.cls_score, self.bbox_pred]:
             nn.init.constant_(l.bias, 0)
+        # (key, weight, bias) of both layers concatenated, see `_fused_weight_and_bias`
+        self._fused_params = None
+        self._quantized = False
 
         self.box2box_transform = box2box_transform
         self.smooth_l1_beta = smooth_l1_beta
@@ -737,10 +925,54 @@ class FastRCNNOutputLayers(nn.Module):
         """
         if x.dim() > 2:
             x = torch.flatten(x, start_dim=1)
-        scores = self.cls_score(x)
-        proposal_deltas = self.bbox_pred(x)
+        if self.training or torch.is_grad_enabled() or x.numel() == 0 or self._quantized:
+            scores = self.cls_score(x)
+            proposal_deltas = self.bbox_pred(x)
+            return scores, proposal_deltas
+        # At inference both predictions are computed with a single GEMM
+        weight, bias = self._fused_weight_and_bias()
+        scores, proposal_deltas = F.linear(x, weight, bias).split(
+            [self.cls_score.out_features, self.bbox_pred.out_features], dim=1
+        )
         return scores, proposal_deltas
 
+    def quantize_dynamic(self):
+        """
+        Replace `cls_score` and `bbox_pred` by int8 dynamically quantized linear layers:
+        their weights are stored in int8 and their inputs are quantized on the fly, while
+        the predicted scores and deltas stay in floating point.
+
+        This is for CPU inference only: it should be called after the weights are loaded,
+        and the resulting state_dict no longer matches the one of the float model.
+
+        Returns:
+            nn.Module: this FastRCNNOutputLayers itself
+        """
+        torch.quantization.quantize_dynamic(
+            self, {"cls_score", "bbox_pred"}, dtype=torch.qint8, inplace=True
+        )
+        self._fused_params = None
+        self._quantized = True
+        return self
+
+    def _fused_weight_and_bias(self):
+        """
+        Returns:
+            Tensor, Tensor: the weights and biases of `cls_score` and `bbox_pred`
+                concatenated along the output dimension. They are cached, and rebuilt
+                whenever a parameter is replaced or modified in place (e.g. by loading a
+                checkpoint or moving the model).
+        """
+        params = [self.cls_score.weight, self.bbox_pred.weight]
+        params += [self.cls_score.bias, self.bbox_pred.bias]
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        if self._fused_params is None or self._fused_params[0] != key:
+            with torch.no_grad():
+                weight = torch.cat(params[:2], dim=0)
+                bias = torch.cat(params[2:], dim=0)
+            self._fused_params = (key, weight, bias)
+        return self._fused_params[1:]
+
     # TODO: move the implementation to this class.
     def losses(self, predictions, proposals):
         """
@@ -766,13 +998,16 @@ class FastRCNNOutputLayers(nn.Module):
             list[Instances]: same as `fast_rcnn_inference`.
             list[Tensor]: same as `fast_rcnn_inference`.
         """
-        boxes = self.predict_boxes(predictions, proposals)
-        scores = self.predict_probs(predictions, proposals)
-        image_shapes = [x.image_size for x in proposals]
-        return fast_rcnn_inference(
-            boxes,
-            scores,
-            image_shapes,
+        if not len(proposals):
+            return [], []
+        # Same as `fast_rcnn_inference` on the outputs of `predict_boxes` and
+        # `predict_probs`, without splitting the predictions per image and
+        # concatenating them back
+        return _fast_rcnn_inference_batched(
+            self._predict_boxes_batched(predictions, proposals),
+            self._predict_probs_batched(predictions, proposals),
+            [len(p) for p in proposals],
+            [x.image_size for x in proposals],
             self.test_score_thresh,
             self.test_nms_thresh,
             self.test_topk_per_image,
@@ -802,9 +1037,8 @@ class FastRCNNOutputLayers(nn.Module):
             # cannot be used as index.
             gt_classes = gt_classes.clamp_(0, K - 1)
 
-            predict_boxes = predict_boxes.view(N, K, B)[
-                torch.arange(N, dtype=torch.long, device=predict_boxes.device), gt_classes
-            ]
+            gt_classes = gt_classes[:, None, None].expand(-1, 1, B)
+            predict_boxes = predict_boxes.view(N, K, B).gather(1, gt_classes).squeeze(1)
         num_prop_per_image = [len(p) for p in proposals]
         return predict_boxes.split(num_prop_per_image)
 
@@ -817,14 +1051,19 @@ class FastRCNNOutputLayers(nn.Module):
         """
         if not len(proposals):
             return []
-        _, proposal_deltas = predictions
         num_prop_per_image = [len(p) for p in proposals]
+        return self._predict_boxes_batched(predictions, proposals).split(num_prop_per_image)
+
+    def _predict_boxes_batched(self, predictions, proposals):
+        """
+        Returns:
+            Tensor: (R, K * B) or (R, B) the boxes of :meth:`predict_boxes`, for the
+                proposals of all images concatenated.
+        """
+        _, proposal_deltas = predictions
         proposal_boxes = [p.proposal_boxes for p in proposals]
         proposal_boxes = proposal_boxes[0].cat(proposal_boxes).tensor
-        predict_boxes = self.box2box_transform.apply_deltas(
-            proposal_deltas, proposal_boxes
-        )  # Nx(KxB)
-        return predict_boxes.split(num_prop_per_image)
+        return self.box2box_transform.apply_deltas(proposal_deltas, proposal_boxes)  # Nx(KxB)
 
     def predict_probs(self, predictions, proposals):
         """
@@ -833,7 +1072,15 @@ class FastRCNNOutputLayers(nn.Module):
                 Element i has shape (Ri, K + 1), where Ri is the number of predicted objects
                 for image i.
         """
-        scores, _ = predictions
         num_inst_per_image = [len(p) for p in proposals]
-        probs = F.softmax(scores, dim=-1)
+        probs = self._predict_probs_batched(predictions, proposals)
         return probs.split(num_inst_per_image, dim=0)
+
+    def _predict_probs_batched(self, predictions, proposals):
+        """
+        Returns:
+            Tensor: (R, K + 1) the probabilities of :meth:`predict_probs`, for the
+                proposals of all images concatenated.
+        """
+        scores, _ = predictions
+        return F.softmax(scores, dim=-1)
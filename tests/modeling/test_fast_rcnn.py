@@ -1,11 +1,18 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import logging
+import math
 import unittest
 import torch
 
-from detectron2.layers import ShapeSpec
+from detectron2.config import get_cfg
+from detectron2.layers import ShapeSpec, batched_nms
 from detectron2.modeling.box_regression import Box2BoxTransform, Box2BoxTransformRotated
-from detectron2.modeling.roi_heads.fast_rcnn import FastRCNNOutputLayers
+from detectron2.modeling.roi_heads.fast_rcnn import (
+    FastRCNNOutputLayers,
+    FastRCNNOutputs,
+    fast_rcnn_inference,
+    fast_rcnn_inference_single_image,
+)
 from detectron2.modeling.roi_heads.rotated_fast_rcnn import RotatedFastRCNNOutputLayers
 from detectron2.structures import Boxes, Instances, RotatedBoxes
 from detectron2.utils.events import EventStorage
@@ -13,6 +20,171 @@ from detectron2.utils.events import EventStorage
 logger = logging.getLogger(__name__)
 
 
+def _reference_inference_single_image(
+    boxes, scores, image_shape, score_thresh, nms_thresh, topk_per_image
+):
+    """
+    Per-image inference with `detectron2.layers.batched_nms`, for finite inputs.
+    Returns the kept boxes, scores, classes and indices of the input rows.
+    """
+    scores = scores[:, :-1]
+    num_bbox_reg_classes = boxes.shape[1] // 4
+    boxes = Boxes(boxes.reshape(-1, 4))
+    boxes.clip(image_shape)
+    boxes = boxes.tensor.view(-1, num_bbox_reg_classes, 4)
+    filter_mask = scores > score_thresh
+    filter_inds = filter_mask.nonzero()
+    if num_bbox_reg_classes == 1:
+        boxes = boxes[filter_inds[:, 0], 0]
+    else:
+        boxes = boxes[filter_mask]
+    scores = scores[filter_mask]
+    keep = batched_nms(boxes, scores, filter_inds[:, 1], nms_thresh)[:topk_per_image]
+    return boxes[keep], scores[keep], filter_inds[keep, 1], filter_inds[keep, 0]
+
+
+def _reference_bbox_transform(deltas, weights, scale_clamp):
+    """
+    Decode (dx, dy, dw, dh) deltas to (x1, y1, x2, y2) in delta space, as the original
+    FastRCNNOutputs.bbox_transform.
+    """
+    wx, wy, ww, wh = weights
+    dx = deltas[:, 0::4] / wx
+    dy = deltas[:, 1::4] / wy
+    dw = torch.clamp(deltas[:, 2::4] / ww, max=scale_clamp)
+    dh = torch.clamp(deltas[:, 3::4] / wh, max=scale_clamp)
+    pred_w = torch.exp(dw)
+    pred_h = torch.exp(dh)
+    x1 = dx - 0.5 * pred_w
+    y1 = dy - 0.5 * pred_h
+    x2 = dx + 0.5 * pred_w
+    y2 = dy + 0.5 * pred_h
+    return x1.view(-1), y1.view(-1), x2.view(-1), y2.view(-1)
+
+
+def _reference_diou_loss(outputs):
+    """
+    The original DIoU loss of FastRCNNOutputs.compute_diou, with unclamped intersection.
+    """
+    transform = outputs.box2box_transform
+    target_delta = transform.get_deltas(outputs.proposals.tensor, outputs.gt_boxes.tensor)
+    bg_class_ind = outputs.pred_class_logits.shape[1] - 1
+    fg_inds = torch.nonzero(
+        (outputs.gt_classes >= 0) & (outputs.gt_classes < bg_class_ind), as_tuple=True
+    )[0]
+    output_delta = outputs.pred_proposal_deltas[fg_inds[:, None], torch.arange(4)]
+    target_delta = target_delta[fg_inds]
+
+    x1, y1, x2, y2 = _reference_bbox_transform(
+        output_delta, transform.weights, transform.scale_clamp
+    )
+    x1g, y1g, x2g, y2g = _reference_bbox_transform(
+        target_delta, transform.weights, transform.scale_clamp
+    )
+    x2 = torch.max(x1, x2)
+    y2 = torch.max(y1, y2)
+    x_p = (x2 + x1) / 2
+    y_p = (y2 + y1) / 2
+    x_g = (x1g + x2g) / 2
+    y_g = (y1g + y2g) / 2
+    xkis1 = torch.max(x1, x1g)
+    ykis1 = torch.max(y1, y1g)
+    xkis2 = torch.min(x2, x2g)
+    ykis2 = torch.min(y2, y2g)
+    xc1 = torch.min(x1, x1g)
+    yc1 = torch.min(y1, y1g)
+    xc2 = torch.max(x2, x2g)
+    yc2 = torch.max(y2, y2g)
+    intsctk = (xkis2 - xkis1) * (ykis2 - ykis1)
+    unionk = (x2 - x1) * (y2 - y1) + (x2g - x1g) * (y2g - y1g) - intsctk + 1e-7
+    iouk = intsctk / unionk
+    c = ((xc2 - xc1) ** 2) + ((yc2 - yc1) ** 2) + 1e-7
+    d = ((x_p - x_g) ** 2) + ((y_p - y_g) ** 2)
+    diouk = iouk - d / c
+    loss = (1 - diouk).sum() / outputs.gt_classes.numel()
+    return loss * outputs.cfg.MODEL.ROI_BOX_HEAD.LOSS_BOX_WEIGHT
+
+
+def _reference_ciou_loss(outputs):
+    """
+    The original CIoU loss of FastRCNNOutputs.compute_ciou, with a masked intersection,
+    two atan and an alpha computed under no_grad.
+    """
+    transform = outputs.box2box_transform
+    target = transform.get_deltas(outputs.proposals.tensor, outputs.gt_boxes.tensor)
+    x1, y1, x2, y2 = _reference_bbox_transform(
+        outputs.pred_proposal_deltas, transform.weights, transform.scale_clamp
+    )
+    x1g, y1g, x2g, y2g = _reference_bbox_transform(
+        target, transform.weights, transform.scale_clamp
+    )
+    x2 = torch.max(x1, x2)
+    y2 = torch.max(y1, y2)
+    w_pred = x2 - x1
+    h_pred = y2 - y1
+    w_gt = x2g - x1g
+    h_gt = y2g - y1g
+    x_center = (x2 + x1) / 2
+    y_center = (y2 + y1) / 2
+    x_center_g = (x1g + x2g) / 2
+    y_center_g = (y1g + y2g) / 2
+    xkis1 = torch.max(x1, x1g)
+    ykis1 = torch.max(y1, y1g)
+    xkis2 = torch.min(x2, x2g)
+    ykis2 = torch.min(y2, y2g)
+    xc1 = torch.min(x1, x1g)
+    yc1 = torch.min(y1, y1g)
+    xc2 = torch.max(x2, x2g)
+    yc2 = torch.max(y2, y2g)
+    intsctk = torch.zeros_like(x1)
+    mask = (ykis2 > ykis1) * (xkis2 > xkis1)
+    intsctk[mask] = (xkis2[mask] - xkis1[mask]) * (ykis2[mask] - ykis1[mask])
+    unionk = (x2 - x1) * (y2 - y1) + (x2g - x1g) * (y2g - y1g) - intsctk + 1e-7
+    iouk = intsctk / unionk
+    c = ((xc2 - xc1) ** 2) + ((yc2 - yc1) ** 2) + 1e-7
+    d = ((x_center - x_center_g) ** 2) + ((y_center - y_center_g) ** 2)
+    u = d / c
+    v = (4 / (math.pi ** 2)) * torch.pow(
+        (torch.atan(w_gt / h_gt) - torch.atan(w_pred / h_pred)), 2
+    )
+    with torch.no_grad():
+        alpha = v / (1 - iouk + v)
+    ciouk = iouk - (u + alpha * v)
+
+    bg_class_ind = outputs.pred_class_logits.shape[1] - 1
+    fg_inds = torch.nonzero(
+        (outputs.gt_classes >= 0) & (outputs.gt_classes < bg_class_ind), as_tuple=True
+    )[0]
+    loss = (1 - ciouk[fg_inds]).sum() / outputs.gt_classes.numel()
+    return loss * outputs.cfg.MODEL.ROI_BOX_HEAD.LOSS_BOX_WEIGHT
+
+
+def _build_outputs(num_classes, cls_agnostic_bbox_reg, num_proposals=32):
+    """
+    FastRCNNOutputs for random proposals, with background proposals and with predicted
+    deltas large enough that many predicted boxes do not overlap their targets.
+    """
+    xy = torch.rand(num_proposals, 2) * 50
+    proposal_boxes = torch.cat([xy, xy + torch.rand(num_proposals, 2) * 20 + 5], dim=1)
+    gt_boxes = proposal_boxes + torch.rand(num_proposals, 4) * 2 - 1
+    proposal = Instances((100, 100))
+    proposal.proposal_boxes = Boxes(proposal_boxes)
+    proposal.gt_boxes = Boxes(gt_boxes)
+    proposal.gt_classes = torch.randint(0, num_classes + 1, (num_proposals,))
+
+    num_bbox_reg_classes = 1 if cls_agnostic_bbox_reg else num_classes
+    deltas = torch.randn(num_proposals, num_bbox_reg_classes * 4) * 10
+    outputs = FastRCNNOutputs(
+        Box2BoxTransform(weights=(10.0, 10.0, 5.0, 5.0)),
+        torch.randn(num_proposals, num_classes + 1),
+        deltas.requires_grad_(),
+        [proposal],
+    )
+    outputs.cfg = get_cfg()
+    outputs.cfg.MODEL.ROI_BOX_HEAD.LOSS_BOX_WEIGHT = 2.0
+    return outputs
+
+
 class FastRCNNTest(unittest.TestCase):
     def test_fast_rcnn(self):
         torch.manual_seed(132)
@@ -101,6 +273,134 @@ class FastRCNNTest(unittest.TestCase):
         for name in expected_losses.keys():
             assert torch.allclose(losses[name], expected_losses[name])
 
+    def test_fast_rcnn_fused_forward(self):
+        torch.manual_seed(132)
+        box_predictor = FastRCNNOutputLayers(
+            ShapeSpec(channels=8),
+            box2box_transform=Box2BoxTransform(weights=(10, 10, 5, 5)),
+            num_classes=5,
+        )
+        for param in box_predictor.parameters():
+            param.data.normal_()
+        feature_pooled = torch.rand(4, 8)
+        scores, proposal_deltas = box_predictor(feature_pooled)
+
+        box_predictor.eval()
+        with torch.no_grad():
+            fused_scores, fused_proposal_deltas = box_predictor(feature_pooled)
+            self.assertTrue(torch.allclose(fused_scores, scores, atol=1e-5))
+            self.assertTrue(torch.allclose(fused_proposal_deltas, proposal_deltas, atol=1e-5))
+            # in-place updates of the parameters invalidate the fused weights
+            box_predictor.bbox_pred.weight.zero_()
+            _, fused_proposal_deltas = box_predictor(feature_pooled)
+        bias = box_predictor.bbox_pred.bias.expand_as(fused_proposal_deltas)
+        self.assertTrue(torch.allclose(fused_proposal_deltas, bias))
+
+    @unittest.skipIf(
+        not {"fbgemm", "qnnpack"} & set(torch.backends.quantized.supported_engines),
+        "Quantized engines not available",
+    )
+    def test_fast_rcnn_quantize_dynamic(self):
+        torch.manual_seed(132)
+        box_predictor = FastRCNNOutputLayers(
+            ShapeSpec(channels=8),
+            box2box_transform=Box2BoxTransform(weights=(10, 10, 5, 5)),
+            num_classes=5,
+        ).eval()
+        for param in box_predictor.parameters():
+            param.data.uniform_(-1, 1)
+        feature_pooled = torch.rand(4, 8)
+        with torch.no_grad():
+            scores, proposal_deltas = box_predictor(feature_pooled)
+            q_scores, q_proposal_deltas = box_predictor.quantize_dynamic()(feature_pooled)
+        self.assertTrue(torch.allclose(q_scores, scores, atol=0.1))
+        self.assertTrue(torch.allclose(q_proposal_deltas, proposal_deltas, atol=0.1))
+
+    def test_fast_rcnn_inference_batched(self):
+        torch.manual_seed(132)
+        image_shapes = [(30, 40), (50, 20), (10, 10)]
+        num_classes = 3
+        boxes, scores = [], []
+        for num_preds in [20, 0, 15]:
+            xy = torch.rand(num_preds, num_classes, 2) * 40
+            wh = torch.rand(num_preds, num_classes, 2) * 20
+            boxes.append(torch.cat([xy, xy + wh], dim=2).view(num_preds, -1))
+            scores.append(torch.rand(num_preds, num_classes + 1).softmax(dim=1))
+
+        results, kept_indices = fast_rcnn_inference(boxes, scores, image_shapes, 0.2, 0.5, 5)
+        self.assertEqual(len(results), len(image_shapes))
+        for i, image_shape in enumerate(image_shapes):
+            expected, expected_inds = fast_rcnn_inference_single_image(
+                boxes[i], scores[i], image_shape, 0.2, 0.5, 5
+            )
+            self.assertEqual(results[i].image_size, image_shape)
+            self.assertTrue(torch.equal(results[i].pred_classes, expected.pred_classes))
+            self.assertTrue(torch.equal(kept_indices[i], expected_inds))
+            self.assertTrue(torch.allclose(results[i].scores, expected.scores))
+            self.assertTrue(
+                torch.allclose(results[i].pred_boxes.tensor, expected.pred_boxes.tensor)
+            )
+
+    def test_fast_rcnn_inference_non_contiguous(self):
+        torch.manual_seed(132)
+        num_classes = 3
+        xy = torch.rand(num_classes, 2, 20) * 40
+        wh = torch.rand(num_classes, 2, 20) * 20
+        # (R, C * 4) transposed view of a (C * 4, R) tensor
+        boxes = torch.cat([xy, xy + wh], dim=1).view(-1, 20).t()
+        scores = torch.rand(20, num_classes + 1).softmax(dim=1)
+        self.assertFalse(boxes.is_contiguous())
+
+        results, inds = fast_rcnn_inference_single_image(boxes, scores, (30, 40), 0.2, 0.5, 5)
+        expected, expected_inds = fast_rcnn_inference_single_image(
+            boxes.contiguous(), scores, (30, 40), 0.2, 0.5, 5
+        )
+        self.assertTrue(torch.equal(inds, expected_inds))
+        self.assertTrue(torch.equal(results.pred_boxes.tensor, expected.pred_boxes.tensor))
+
+    def test_fast_rcnn_inference_batched_many_groups(self):
+        # Many small, overlapping boxes in large images, with many images and classes:
+        # the NMS groups must stay apart without losing float32 precision.
+        torch.manual_seed(132)
+        image_shapes = [(800, 1333)] * 8
+        num_classes = 50
+        boxes, scores = [], []
+        for _ in image_shapes:
+            xy = torch.rand(100, 1, 2) * 20 + torch.tensor([1300.0, 770.0])
+            wh = torch.rand(100, num_classes, 2) * 6 + 2
+            boxes.append(torch.cat([xy.expand_as(wh), xy + wh], dim=2).view(100, -1))
+            scores.append(torch.rand(100, num_classes + 1).softmax(dim=1))
+
+        results, kept_indices = fast_rcnn_inference(boxes, scores, image_shapes, 0.01, 0.5, 100)
+        for i, image_shape in enumerate(image_shapes):
+            exp_boxes, exp_scores, exp_classes, exp_inds = _reference_inference_single_image(
+                boxes[i], scores[i], image_shape, 0.01, 0.5, 100
+            )
+            self.assertTrue(torch.equal(results[i].pred_classes, exp_classes))
+            self.assertTrue(torch.equal(kept_indices[i], exp_inds))
+            self.assertTrue(torch.allclose(results[i].scores, exp_scores))
+            self.assertTrue(torch.allclose(results[i].pred_boxes.tensor, exp_boxes))
+
+    def _check_box_loss(self, outputs, loss, expected_loss):
+        deltas = outputs.pred_proposal_deltas
+        grad = torch.autograd.grad(loss, deltas)[0]
+        expected_grad = torch.autograd.grad(expected_loss, deltas)[0]
+        self.assertTrue(torch.allclose(loss, expected_loss, rtol=1e-4, atol=1e-5))
+        self.assertTrue(torch.allclose(grad, expected_grad, rtol=1e-4, atol=1e-5))
+
+    def test_fast_rcnn_diou_loss(self):
+        torch.manual_seed(132)
+        for cls_agnostic_bbox_reg in [False, True]:
+            outputs = _build_outputs(5, cls_agnostic_bbox_reg)
+            self._check_box_loss(outputs, outputs.compute_diou(), _reference_diou_loss(outputs))
+
+    def test_fast_rcnn_ciou_loss(self):
+        torch.manual_seed(132)
+        # The CIoU loss decodes all the predicted deltas of a proposal against its single
+        # target, so it only supports class-agnostic regression.
+        outputs = _build_outputs(5, cls_agnostic_bbox_reg=True)
+        self._check_box_loss(outputs, outputs.compute_ciou(), _reference_ciou_loss(outputs))
+
 
 if __name__ == "__main__":
     unittest.main()
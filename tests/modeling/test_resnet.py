@@ -0,0 +1,163 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+import unittest
+import torch
+
+from detectron2.config import get_cfg
+from detectron2.layers import ShapeSpec
+from detectron2.modeling.backbone.resnet import (
+    BasicStem,
+    BottleneckBlock,
+    DeformBottleneckBlock,
+    ResNet,
+    build_resnet_backbone,
+)
+
+
+def _build_resnet(norm="BN"):
+    stem = BasicStem(in_channels=3, out_channels=16, norm=norm)
+    stages = [
+        ResNet.make_stage(
+            BottleneckBlock,
+            2,
+            first_stride=1 if idx == 0 else 2,
+            in_channels=16 if idx == 0 else 32,
+            out_channels=32,
+            bottleneck_channels=8,
+            norm=norm,
+            radix=1,
+        )
+        for idx in range(2)
+    ]
+    return ResNet(stem, stages, out_features=["res2", "res3"])
+
+
+class ResNetTest(unittest.TestCase):
+    def test_fuse_bn(self):
+        torch.manual_seed(0)
+        model = _build_resnet()
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.5, 0.5)
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 1.5)
+        model.eval()
+        x = torch.rand(2, 3, 64, 64)
+        with torch.no_grad():
+            expected = model(x)
+            outputs = model.fuse_bn()(x)
+        self.assertFalse(any(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules()))
+        for name, output in outputs.items():
+            self.assertTrue(torch.allclose(output, expected[name], atol=1e-4))
+
+    def test_fuse_frozen_bn(self):
+        torch.manual_seed(0)
+        model = _build_resnet(norm="FrozenBN").freeze(3)
+        x = torch.rand(2, 3, 64, 64)
+        with torch.no_grad():
+            expected = model(x)
+            outputs = model.fuse_bn()(x)
+        for name, output in outputs.items():
+            self.assertTrue(torch.allclose(output, expected[name], atol=1e-4))
+
+    def test_build_r18(self):
+        cfg = get_cfg()
+        cfg.MODEL.RESNETS.DEPTH = 18
+        cfg.MODEL.RESNETS.RES2_OUT_CHANNELS = 64
+        cfg.MODEL.RESNETS.OUT_FEATURES = ["res2", "res3", "res4", "res5"]
+        for deep_stem in [False, True]:
+            cfg.MODEL.RESNETS.DEEP_STEM = deep_stem
+            model = build_resnet_backbone(cfg, ShapeSpec(channels=3)).eval()
+            with torch.no_grad():
+                outputs = model(torch.rand(1, 3, 64, 64))
+            for name, shape in model.output_shape().items():
+                self.assertEqual(outputs[name].shape[1], shape.channels)
+                self.assertEqual(outputs[name].shape[2], 64 // shape.stride)
+            self.assertEqual(model.output_shape()["res5"].channels, 512)
+
+    def test_channels_last(self):
+        torch.manual_seed(0)
+        model = _build_resnet().eval()
+        x = torch.rand(2, 3, 64, 64)
+        with torch.no_grad():
+            expected = model(x)
+            model.channels_last = True
+            outputs = model.to(memory_format=torch.channels_last)(x)
+        for name, output in outputs.items():
+            self.assertTrue(torch.allclose(output, expected[name], atol=1e-4))
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA not available")
+    def test_deform_channels_last(self):
+        torch.manual_seed(0)
+        cfg = get_cfg()
+        cfg.MODEL.RESNETS.OUT_FEATURES = ["res3"]
+        cfg.MODEL.RESNETS.DEFORM_ON_PER_STAGE = [False, True, False, False]
+        model = build_resnet_backbone(cfg, ShapeSpec(channels=3))
+        for m in model.modules():
+            if isinstance(m, DeformBottleneckBlock):
+                torch.nn.init.normal_(m.conv2_offset.weight, std=0.01)
+        model = model.cuda().eval()
+
+        cfg.MODEL.RESNETS.CHANNELS_LAST = True
+        model_cl = build_resnet_backbone(cfg, ShapeSpec(channels=3))
+        model_cl.load_state_dict(model.state_dict())
+        model_cl = model_cl.cuda().eval()
+
+        x = torch.rand(2, 3, 64, 64, device="cuda")
+        with torch.no_grad():
+            expected = model(x)
+            outputs = model_cl(x)
+        for name, output in outputs.items():
+            self.assertTrue(torch.allclose(output, expected[name], atol=1e-3))
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA not available")
+    def test_deform_fp16(self):
+        torch.manual_seed(0)
+        cfg = get_cfg()
+        cfg.MODEL.RESNETS.OUT_FEATURES = ["res3"]
+        cfg.MODEL.RESNETS.DEFORM_ON_PER_STAGE = [False, True, False, False]
+        cfg.MODEL.RESNETS.DEFORM_MODULATED = True
+        model = build_resnet_backbone(cfg, ShapeSpec(channels=3)).cuda().eval()
+
+        cfg.MODEL.RESNETS.FP16 = True
+        model_fp16 = build_resnet_backbone(cfg, ShapeSpec(channels=3))
+        model_fp16.load_state_dict(model.state_dict())
+        model_fp16 = model_fp16.cuda().eval()
+
+        x = torch.rand(2, 3, 64, 64, device="cuda")
+        with torch.no_grad():
+            expected = model(x)
+            outputs = model_fp16(x)
+        for name, output in outputs.items():
+            self.assertEqual(output.dtype, torch.float32)
+            self.assertTrue(torch.allclose(output, expected[name], rtol=1e-2, atol=1e-2))
+
+    @unittest.skipIf(
+        not torch.cuda.is_available() or not hasattr(torch.cuda, "CUDAGraph"),
+        "CUDA graphs not available",
+    )
+    def test_cuda_graph(self):
+        torch.manual_seed(0)
+        model = _build_resnet().cuda().eval()
+        x = torch.rand(2, 3, 64, 64, device="cuda")
+        with torch.no_grad():
+            expected = model(x)
+            model.enable_cuda_graph(x)
+            x2 = torch.rand(2, 3, 64, 64, device="cuda")
+            expected2 = model._eager_forward(x2)
+            for inputs, expected_outputs in [(x, expected), (x2, expected2)]:
+                outputs = model(inputs)
+                for name, output in outputs.items():
+                    self.assertTrue(torch.allclose(output, expected_outputs[name], atol=1e-4))
+
+            # other shapes run eagerly
+            x3 = torch.rand(1, 3, 32, 32, device="cuda")
+            outputs = model(x3)
+            expected3 = model._eager_forward(x3)
+            for name, output in outputs.items():
+                self.assertEqual(output.shape, expected3[name].shape)
+                self.assertTrue(torch.allclose(output, expected3[name], atol=1e-4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -22,7 +22,7 @@ from detectron2.data import (
     build_detection_train_loader,
 )
 from detectron2.engine import SimpleTrainer, default_argument_parser, hooks, launch
-from detectron2.modeling import build_model
+from detectron2.modeling import ResNet, build_model
 from detectron2.solver import build_optimizer
 from detectron2.utils import comm
 from detectron2.utils.events import CommonMetricPrinter
@@ -121,6 +121,10 @@ def benchmark_eval(args):
     model.eval()
     logger.info("Model:\n{}".format(model))
     DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    if cfg.MODEL.RESNETS.FUSE_BN_EVAL:
+        for module in model.modules():
+            if isinstance(module, ResNet):
+                module.fuse_bn()
 
     cfg.defrost()
     cfg.DATALOADER.NUM_WORKERS = 0